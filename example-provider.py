@@ -3,18 +3,27 @@
 """External engine provider example for lichess.org"""
 
 import argparse
-import concurrent.futures
 import contextlib
 import logging
 import multiprocessing
 import os
+import queue
 import requests
 import secrets
+import shlex
 import subprocess
 import sys
 import time
 import threading
 
+try:
+    import orjson
+except ImportError:
+    import json
+    _json_loads = json.loads
+else:
+    _json_loads = orjson.loads
+
 _LOG_LEVEL_MAP = {
         "critical": logging.CRITICAL,
         "error": logging.CRITICAL,
@@ -24,6 +33,17 @@ _LOG_LEVEL_MAP = {
         "notset": logging.NOTSET,
         }
 
+_VARIANTS = frozenset([
+        "chess",
+        "antichess",
+        "atomic",
+        "crazyhouse",
+        "horde",
+        "kingofthehill",
+        "racingkings",
+        "3check",
+        ])
+
 
 def ok(res):
     try:
@@ -39,30 +59,19 @@ def register_engine(args, http, engine):
 
     secret = args.provider_secret or secrets.token_urlsafe(32)
 
-    variants = {
-        "chess",
-        "antichess",
-        "atomic",
-        "crazyhouse",
-        "horde",
-        "kingofthehill",
-        "racingkings",
-        "3check",
-    }
-
     registration = {
         "name": args.name,
         "maxThreads": args.max_threads,
         "maxHash": args.max_hash,
-        "variants": [variant for variant in engine.supported_variants or ["chess"] if variant in variants],
+        "variants": [variant for variant in engine.supported_variants or ["chess"] if variant in _VARIANTS],
         "providerSecret": secret,
     }
 
-    for engine in res.json():
-        if engine["name"] == args.name:
-            logging.info("Updating engine %s", engine["id"])
-            ok(http.put(f"{args.lichess}/api/external-engine/{engine['id']}", json=registration))
-            break
+    by_name = {engine["name"]: engine for engine in reversed(_json_loads(res.content))}
+    existing = by_name.get(args.name)
+    if existing:
+        logging.info("Updating engine %s", existing["id"])
+        ok(http.put(f"{args.lichess}/api/external-engine/{existing['id']}", json=registration))
     else:
         logging.info("Registering new engine")
         ok(http.post(f"{args.lichess}/api/external-engine", json=registration))
@@ -71,26 +80,30 @@ def register_engine(args, http, engine):
 
 
 def main(args):
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
     engine = Engine(args)
     http = requests.Session()
+    http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
     http.headers["Authorization"] = f"Bearer {args.token}"
     secret = register_engine(args, http, engine)
 
-    last_future = concurrent.futures.Future()
-    last_future.set_result(None)
+    broker = requests.Session()
+    broker.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=requests.adapters.Retry(total=0, read=False)))
+
+    jobs = queue.Queue(maxsize=1)
+    job_started = threading.Event()
+    threading.Thread(target=work_loop, args=(args, broker, jobs, job_started), daemon=True).start()
 
     backoff = 1
     while True:
         try:
-            res = ok(http.post(f"{args.broker}/api/external-engine/work", json={"providerSecret": secret}, timeout=12))
+            res = ok(broker.post(args.work_url, json={"providerSecret": secret}, timeout=(5, 30)))
             if res.status_code != 200:
                 if engine.alive and engine.idle_time() > args.keep_alive:
                     logging.info("Terminating idle engine")
                     engine.terminate()
                 continue
-            job = res.json()
-        except requests.exceptions.RequestException as err:
+            job = _json_loads(res.content)
+        except (requests.exceptions.RequestException, ValueError) as err:
             logging.error("Error while trying to acquire work: %s", err)
             backoff = min(backoff * 1.5, 10)
             time.sleep(backoff)
@@ -102,21 +115,32 @@ def main(args):
             engine.stop()
         except EOFError:
             pass
-        last_future.result()
+        jobs.join()
 
         if not engine.alive:
             engine = Engine(args)
 
-        job_started = threading.Event()
-        last_future = executor.submit(handle_job, args, engine, job, job_started)
+        job_started.clear()
+        jobs.put((engine, job))
         job_started.wait()
 
 
-def handle_job(args, engine, job, job_started):
+def work_loop(args, http, jobs, job_started):
+    while True:
+        engine, job = jobs.get()
+        try:
+            handle_job(args, http, engine, job, job_started)
+        except Exception:
+            logging.exception("Unexpected error while handling job %s", job["id"])
+        finally:
+            jobs.task_done()
+
+
+def handle_job(args, http, engine, job, job_started):
     try:
         logging.info("Handling job %s", job["id"])
         with engine.analyse(job, job_started) as analysis_stream:
-            ok(requests.post(f"{args.broker}/api/external-engine/work/{job['id']}", data=analysis_stream))
+            ok(http.post(f"{args.work_url}/{job['id']}", data=analysis_stream))
     except requests.exceptions.ConnectionError:
         logging.info("Connection closed while streaming analysis")
     except requests.exceptions.RequestException as err:
@@ -131,17 +155,24 @@ def handle_job(args, engine, job, job_started):
 
 class Engine:
     def __init__(self, args):
-        self.process = subprocess.Popen(args.engine, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=1, universal_newlines=True)
+        self.process = subprocess.Popen(args.engine_command, shell=args.shell, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self.buf = b""
+        self.buf_pos = 0
         self.args = args
         self.session_id = None
         self.hash = None
         self.threads = None
         self.multi_pv = None
         self.uci_variant = None
+        self.position_fen = None
+        self.position_moves = []
+        self.position = None
         self.supported_variants = []
         self.last_used = time.monotonic()
         self.alive = True
-        self.stop_lock = threading.Lock()
+        self.searching = False
+        self.stopping = threading.Event()
+        self.debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
         self.uci()
         self.setoption("UCI_AnalyseMode", "true")
@@ -156,129 +187,198 @@ class Engine:
         self.process.terminate()
         self.alive = False
 
-    def send(self, command):
-        logging.debug("%d << %s", self.process.pid, command)
-        self.process.stdin.write(command + "\n")
-        self.process.stdin.flush()
+    def send(self, *commands):
+        if self.debug:
+            for command in commands:
+                logging.debug("%d << %s", self.process.pid, command)
+        try:
+            self.process.stdin.write("".join(command + "\n" for command in commands).encode("utf-8"))
+        except OSError:
+            self.alive = False
+            raise EOFError()
 
-    def recv(self):
+    def readline(self):
         while True:
-            line = self.process.stdout.readline()
-            if line == "":
-                self.alive = False
-                raise EOFError()
-
-            line = line.rstrip()
-            if not line:
+            end = self.buf.find(b"\n", self.buf_pos)
+            if end < 0:
+                chunk = os.read(self.process.stdout.fileno(), 65536)
+                if not chunk:
+                    self.alive = False
+                    raise EOFError()
+                self.buf = self.buf[self.buf_pos:] + chunk
+                self.buf_pos = 0
                 continue
 
-            logging.debug("%d >> %s", self.process.pid, line)
+            line = self.buf[self.buf_pos:end].rstrip()
+            self.buf_pos = end + 1
+            if line:
+                return line
+
+    def has_buffered_line(self):
+        return self.buf.find(b"\n", self.buf_pos) >= 0
+
+    def recv(self):
+        line = self.readline()
 
-            command_and_params = line.split(None, 1)
+        if self.debug:
+            logging.debug("%d >> %s", self.process.pid, line.decode("utf-8", "replace"))
 
-            if len(command_and_params) == 1:
-                return command_and_params[0], ""
-            else:
-                return command_and_params
+        if line.startswith(b"info "):
+            return b"info", line
+        elif line == b"readyok" or line == b"uciok":
+            return line, line
+        else:
+            return line.split(None, 1)[0], line
 
     def uci(self):
         self.send("uci")
         while True:
-            command, args = self.recv()
-            if command == "option":
+            command, line = self.recv()
+            if command == b"option":
                 name = None
-                args = args.split()
+                args = line.split()[1:]
                 while args:
                     arg = args.pop(0)
-                    if arg == "name":
+                    if arg == b"name":
                         name = args.pop(0)
-                    elif name == "UCI_Variant" and arg == "var":
-                        self.supported_variants.append(args.pop(0))
-            elif command == "uciok":
+                    elif name == b"UCI_Variant" and arg == b"var":
+                        self.supported_variants.append(args.pop(0).decode("utf-8", "replace"))
+            elif command == b"uciok":
                 break
 
         if self.supported_variants:
             logging.info("Supported variants: %s", ", ".join(self.supported_variants))
 
-    def isready(self):
-        self.send("isready")
+    def isready(self, *commands):
+        self.send(*commands, "isready")
         while True:
-            line, _ = self.recv()
-            if line == "readyok":
+            command, _ = self.recv()
+            if command == b"readyok":
                 break
 
     def setoption(self, name, value):
         self.send(f"setoption name {name} value {value}")
 
+    def set_position(self, fen, moves):
+        played = len(self.position_moves)
+        if fen == self.position_fen and moves[:played] == self.position_moves:
+            if len(moves) == played:
+                return
+            self.position += " " + " ".join(moves[played:])
+        else:
+            self.position = f"position fen {fen} moves"
+            if moves:
+                self.position += " " + " ".join(moves)
+        self.position_fen = fen
+        self.position_moves = moves
+        self.send(self.position)
+
     @contextlib.contextmanager
     def analyse(self, job, job_started):
         work = job["work"]
 
+        commands = []
         if work["sessionId"] != self.session_id:
             self.session_id = work["sessionId"]
-            self.send("ucinewgame")
-            self.isready()
-
-        options_changed = False
+            commands.append("ucinewgame")
+            self.position_fen = None
         if self.threads != work["threads"]:
-            self.setoption("Threads", work["threads"])
+            commands.append(f"setoption name Threads value {work['threads']}")
             self.threads = work["threads"]
-            options_changed = True
         if self.hash != work["hash"]:
-            self.setoption("Hash", work["hash"])
+            commands.append(f"setoption name Hash value {work['hash']}")
             self.hash = work["hash"]
-            options_changed = True
         if self.multi_pv != work["multiPv"]:
-            self.setoption("MultiPV", work["multiPv"])
+            commands.append(f"setoption name MultiPV value {work['multiPv']}")
             self.multi_pv = work["multiPv"]
-            options_changed = True
         if self.uci_variant != work["variant"]:
-            self.setoption("UCI_Variant", work["variant"])
+            commands.append(f"setoption name UCI_Variant value {work['variant']}")
             self.uci_variant = work["variant"]
-            options_changed = True
-        if options_changed:
-            self.isready()
+            self.position_fen = None
+        if commands:
+            self.isready(*commands)
 
-        self.send(f"position fen {work['initialFen']} moves {' '.join(work['moves'])}")
+        self.set_position(work["initialFen"], work["moves"])
+        self.stopping.clear()
 
         for key in ["movetime", "depth", "nodes"]:
             if key in work:
                 self.send(f"go {key} {work[key]}")
                 break
 
+        self.searching = True
         job_started.set()
 
+        chunks = queue.SimpleQueue()
+        draining = threading.Event()
+
+        def read():
+            chunk = bytearray()
+            try:
+                while not draining.is_set():
+                    # Batch lines that are already buffered, but never hold
+                    # back output while waiting for the engine.
+                    if chunk and (len(chunk) >= 8192 or not self.has_buffered_line()):
+                        chunks.put(bytes(chunk))
+                        chunk.clear()
+
+                    command, line = self.recv()
+                    if command == b"bestmove":
+                        self.searching = False
+                        break
+                    elif command == b"info":
+                        if b" score " in line:
+                            chunk += line
+                            chunk += b"\n"
+                    else:
+                        logging.warning("Unexpected engine command: %s", command.decode("utf-8", "replace"))
+                else:
+                    # Nobody is reading the results any more.
+                    while self.recv()[0] != b"bestmove":
+                        pass
+                    self.searching = False
+
+                if chunk and not draining.is_set():
+                    chunks.put(bytes(chunk))
+            except EOFError:
+                pass
+            finally:
+                chunks.put(None)
+
         def stream():
             while True:
-                command, params = self.recv()
-                if command == "bestmove":
+                chunk = chunks.get()
+                if chunk is None:
                     break
-                elif command == "info":
-                    if "score" in params:
-                        yield (command + " " + params + "\n").encode("utf-8")
-                else:
-                    logging.warning("Unexpected engine command: %s", command)
+                yield chunk
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
 
         analysis = stream()
         try:
             yield analysis
         finally:
+            analysis.close()
+            draining.set()
             self.stop()
-            for _ in analysis:
-                pass
+            reader.join()
+            if not self.alive:
+                raise EOFError()
 
         self.last_used = time.monotonic()
 
     def stop(self):
-        if self.alive:
-            with self.stop_lock:
-                self.send("stop")
+        if self.alive and self.searching and not self.stopping.is_set():
+            self.stopping.set()
+            self.send("stop")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__, fromfile_prefix_chars='@')
     parser.add_argument("--name", default="Alpha 2", help="Engine name to register")
-    parser.add_argument("--engine", help="Shell command to launch UCI engine", required=True)
+    parser.add_argument("--engine", help="Command to launch UCI engine", required=True)
+    parser.add_argument("--shell", action="store_true", help="Launch the engine command through the shell")
     parser.add_argument("--setoption", nargs=2, action="append", default=[], metavar=("NAME", "VALUE"), help="Set a custom UCI option")
     parser.add_argument("--lichess", default="https://lichess.org", help="Defaults to https://lichess.org")
     parser.add_argument("--broker", default="https://engine.lichess.ovh", help="Defaults to https://engine.lichess.ovh")
@@ -297,6 +397,8 @@ if __name__ == "__main__":
         argcomplete.autocomplete(parser)
 
     args = parser.parse_args()
+    args.engine_command = args.engine if args.shell or os.name == "nt" else shlex.split(args.engine)
+    args.work_url = f"{args.broker}/api/external-engine/work"
 
     logging.basicConfig(level=_LOG_LEVEL_MAP[args.log_level])
 